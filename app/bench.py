@@ -0,0 +1,311 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import telemetry
+
+# Headless: the SDL dummy drivers must be selected before pygame is imported anywhere
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+
+def summarize(samples):
+    """Reduce a list of seconds to millisecond statistics."""
+    if not samples:
+        return {'n': 0}
+    ordered = sorted(samples)
+    return {
+        'n': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': ordered[len(ordered) // 2] * 1000,
+        'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+class Timings:
+    """Collects wall-clock samples per stage, optionally scoped to the current turn."""
+
+    def __init__(self):
+        self.samples = {}
+        self.turn = None
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.samples.setdefault(name, []).append(elapsed)
+                if self.turn is not None:
+                    self.turn[name + '_ms'] = self.turn.get(name + '_ms', 0.0) + elapsed * 1000
+        return timed
+
+
+def bench_startup(args):
+    start = time.perf_counter()
+    import llm
+    import_llm = time.perf_counter() - start
+
+    start = time.perf_counter()
+    backend = llm.load_backend(args.backend)
+    if args.backend == 'stub':
+        backend.configure(args.seed, args.stub_text_latency, args.stub_image_latency)
+    if args.backend.startswith('replay:'):
+        backend.latency_scale = args.replay_latency
+    if args.record:
+        from replay import RecordingBackend
+        backend = RecordingBackend(backend, args.record, full_prompts=args.record_prompts)
+    load_backend = time.perf_counter() - start
+
+    start = time.perf_counter()
+    game_engine = llm.TextGameEngine(api_comms=llm.APICommunication(backend=backend))
+    catalog = None
+    if args.catalog:
+        from catalog import ItemCatalog
+        catalog = ItemCatalog(args.catalog, variants=args.item_variants)
+    inventory_engine = llm.InventoryEngine(game_engine.api_comms, 6, catalog=catalog)
+    game_engine.inventory_engine = inventory_engine
+    engine_init = time.perf_counter() - start
+
+    start = time.perf_counter()
+    start_items = inventory_engine.get_start_items()
+    for item in start_items:
+        inventory_engine.add_item(llm.InventoryItem(item['name'], item['description'], item['image']))
+    start_items_time = time.perf_counter() - start
+
+    startup = {
+        'import_llm_ms': import_llm * 1000,
+        'load_backend_ms': load_backend * 1000,
+        'engine_init_ms': engine_init * 1000,
+        'start_items_ms': start_items_time * 1000,
+        'total_ms': (import_llm + load_backend + engine_init + start_items_time) * 1000,
+    }
+    return game_engine, inventory_engine, startup
+
+
+def bench_turns(args, game_engine, timings):
+    api = game_engine.api_comms
+    # Instance-level wrappers so the engine's own calls are timed as well
+    game_engine.self_play = timings.wrap('self_play', game_engine.self_play)
+    game_engine.generate_response = timings.wrap('generate_response', game_engine.generate_response)
+    game_engine.handle_inventory_action = timings.wrap('inventory', game_engine.handle_inventory_action)
+    api.generate_text = timings.wrap('text_inference', api.generate_text)
+    api.generate_image = timings.wrap('image_inference', api.generate_image)
+
+    script = []
+    if args.script:
+        with open(args.script, encoding='utf-8') as f:
+            script = [line.strip() for line in f if line.strip()]
+
+    per_turn = []
+    failures = 0
+    for index in range(args.turns):
+        timings.turn = {'turn': index}
+        start = time.perf_counter()
+        user_input = script[index] if index < len(script) else game_engine.self_play()
+        game_engine.add_user_message(user_input)
+        answer, image_path, score = game_engine.generate_response()
+        timings.turn['total_ms'] = (time.perf_counter() - start) * 1000
+        timings.turn['history_messages'] = len(game_engine.messages)
+        timings.turn['history_tokens'] = api.count_tokens(game_engine.messages)
+        timings.turn['ok'] = answer is not None
+        failures += answer is None
+        per_turn.append(timings.turn)
+        timings.turn = None
+        telemetry.flush()
+
+    summary = {name: summarize(samples) for name, samples in timings.samples.items()}
+    summary['turn'] = summarize([turn['total_ms'] / 1000 for turn in per_turn])
+    return {'summary': summary, 'failures': failures, 'per_turn': per_turn}
+
+
+def bench_count_tokens(args, game_engine):
+    api = game_engine.api_comms
+    history = game_engine.messages[1:] or [{'role': 'user', 'content': 'look around'}]
+    results = []
+    for length in args.history_lengths:
+        # Distinct contents so the per-message token cache sees every message as new
+        prompt = [game_engine.messages[0]] + [dict(history[i % len(history)], content=f"{i} {history[i % len(history)]['content']}")
+                                              for i in range(length)]
+        cold, warm = [], []
+        for _ in range(args.repeat):
+            fresh = type(api)(backend=api.backend)
+            start = time.perf_counter()
+            tokens = fresh.count_tokens(prompt)
+            cold.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            fresh.count_tokens(prompt)
+            warm.append(time.perf_counter() - start)
+        results.append({'messages': length + 1, 'tokens': tokens, 'cold': summarize(cold), 'warm': summarize(warm)})
+    return results
+
+
+def bench_frames(args, game_engine, inventory_engine):
+    import pygame
+    import main
+
+    pygame.init()
+    width, height = args.size
+    main.WIDTH, main.HEIGHT = width, height
+    screen = main.screen = pygame.display.set_mode((width, height))
+    font_size = height // 35
+    font = main.get_font(font_size)
+    text_area_width = int(width * 0.68)
+    input_area_height = font_size * 3
+    image_area_width = width - text_area_width - 20
+    score_position = (text_area_width + text_area_width // 2, 10)
+    image_position = (text_area_width + 10, 20)
+    image_size = (image_area_width - 20, height - 240)
+    inventory_area_size = (image_area_width - 20, 200)
+    inventory_position = (image_position[0], height - inventory_area_size[1] - 20)
+
+    text_buffer = []
+    for message in game_engine.messages[1:]:
+        main.update_text_buffer(text_buffer, message['content'], 8)
+    item = inventory_engine.items[0] if inventory_engine.items else None
+    image_path = item.image_path if item else None
+
+    timings = Timings()
+    draw_text_area = timings.wrap('draw_text_area', main.draw_text_area)
+    draw_user_input_box = timings.wrap('draw_user_input_box', main.draw_user_input_box)
+    draw_inventory = timings.wrap('draw_inventory', inventory_engine.draw_inventory)
+    show_image = timings.wrap('show_image', main.show_image)
+    draw_score = timings.wrap('draw_score', main.draw_score)
+    draw_bordered_box = timings.wrap('draw_bordered_box', main.draw_bordered_box)
+    draw_label = timings.wrap('draw_label', main.draw_label)
+    flip = timings.wrap('flip', pygame.display.flip)
+
+    frames = []
+    for index in range(args.frames):
+        start = time.perf_counter()
+        # Mirrors the body of the main() loop
+        screen.fill(main.BG_COLOR)
+        y_offset = 25
+        for text in text_buffer[-5:]:
+            y_offset = draw_text_area(screen, text, (25, y_offset), main.TEXT_COLOR, font, text_area_width - 20)
+        draw_user_input_box(screen, 'walk north and open the door', (10, height - input_area_height - 10),
+                            text_area_width, input_area_height, font, main.TEXT_COLOR, main.BORDER_COLOR)
+        draw_inventory(screen, inventory_position, inventory_area_size)
+        draw_score(screen, index, score_position, main.TEXT_COLOR, font, image_area_width)
+        if image_path:
+            show_image(screen, image_path, image_position, image_size)
+        draw_bordered_box(screen, (10, 10, text_area_width, height - 20), main.BORDER_COLOR, main.BORDER_WIDTH)
+        draw_bordered_box(screen, (text_area_width + 10, 10, image_area_width - 20, height - 20),
+                          main.BORDER_COLOR, main.BORDER_WIDTH)
+        # Every other frame shows the hover card, the most expensive overlay
+        if item and index % 2:
+            draw_label(screen, item.name, item.description, font, (0, 0), width / 3, item.image_path)
+        flip()
+        frames.append(time.perf_counter() - start)
+
+    result = {name: summarize(samples) for name, samples in timings.samples.items()}
+    result['frame'] = summarize(frames)
+    return result
+
+
+def flatten(report, prefix=''):
+    """Yield (metric, value) pairs for every timing statistic in a report."""
+    for key, value in report.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, list) and key == 'count_tokens':
+            for row in value:
+                yield from flatten(row, f'{prefix}{key}[{row["messages"]}].')
+        elif key.endswith('_ms') and isinstance(value, (int, float)):
+            yield prefix + key, value
+
+
+def compare(baseline, report, threshold, min_delta_ms):
+    """Print metric deltas against a baseline report and return the regressed metrics."""
+    old = dict(flatten({k: v for k, v in baseline.items() if k != 'meta'}))
+    new = dict(flatten({k: v for k, v in report.items() if k != 'meta'}))
+    regressions = []
+    for metric in sorted(old.keys() & new.keys()):
+        before, after = old[metric], new[metric]
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        # Sub-millisecond stages are too noisy to gate on a relative change alone
+        if change > threshold and after - before > min_delta_ms and not metric.endswith('max_ms'):
+            flag = '  REGRESSION'
+            regressions.append(metric)
+        print(f'{metric:60s} {before:10.2f} {after:10.2f} {change:+8.1%}{flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless benchmark for Kalandor turn latency, startup and frame cost.')
+    parser.add_argument('--backend', default='stub',
+                        help="'stub', 'local', 'replay:<archive>' or an importable backend module")
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--script', help='file with one user input per line; self_play fills the remaining turns')
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--size', type=int, nargs=2, default=(1280, 720), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--history-lengths', type=int, nargs='+', default=[1, 10, 50, 100, 200])
+    parser.add_argument('--repeat', type=int, default=20, help='count_tokens repetitions per history length')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stub-text-latency', type=float, default=0.0)
+    parser.add_argument('--stub-image-latency', type=float, default=0.0)
+    parser.add_argument('--replay-latency', type=float, default=0.0,
+                        help='fraction of the recorded inference time to simulate when replaying')
+    parser.add_argument('--catalog', metavar='DIR', help='serve and store items through an item catalog')
+    parser.add_argument('--item-variants', type=int, default=1)
+    parser.add_argument('--record', metavar='ARCHIVE', help='archive every backend call of this run')
+    parser.add_argument('--record-prompts', action='store_true', help='also archive full text prompts (large)')
+    parser.add_argument('--output', default='bench_report.json')
+    parser.add_argument('--compare', help='baseline report to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative slowdown counted as a regression')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help='ignore slowdowns smaller than this')
+    args = parser.parse_args(argv)
+
+    timings = Timings()
+    game_engine, inventory_engine, startup = bench_startup(args)
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'backend': args.backend,
+            'turns': args.turns,
+            'frames': args.frames,
+            'size': list(args.size),
+            'seed': args.seed,
+            'record': args.record,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'startup': startup,
+    }
+    report['turns'] = bench_turns(args, game_engine, timings)
+    if inventory_engine.catalog is not None:
+        report['catalog'] = {'hits': inventory_engine.catalog.hits, 'misses': inventory_engine.catalog.misses,
+                             'entries': len(inventory_engine.catalog)}
+    report['count_tokens'] = bench_count_tokens(args, game_engine)
+    report['render'] = bench_frames(args, game_engine, inventory_engine)
+    if telemetry.enabled:
+        # Per-stage spans (tokenize, prefill, decode, diffusion, ...) when KALANDOR_TRACE is set
+        report['telemetry'] = {
+            'spans': {name: {'last_ms': last, 'mean_ms': mean} for name, (last, mean) in telemetry.summary().items()},
+            'counters': dict(telemetry.counters),
+        }
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report written to {args.output}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f'{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
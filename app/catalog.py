@@ -0,0 +1,219 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+import telemetry
+from session import write_json_atomic
+
+CATALOG_DIR = os.path.expanduser('~/kalandor/items')
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """Exclusive lock shared by every process (farm.py's pool, a running game) using one catalog."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after ten seconds; keep waiting
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def normalize_name(name):
+    """'The Rusty Torch!' and 'rusty  torch' share one catalog entry."""
+    name = re.sub(r'[^\w\s]', ' ', str(name).lower())
+    words = name.split()
+    if words and words[0] in ('a', 'an', 'the'):
+        words = words[1:]
+    return ' '.join(words)
+
+
+class ItemCatalog:
+    """Persistent cache of generated items (name, description, icon) keyed by normalized name.
+
+    Up to `variants` versions are kept per name: lookups miss until that many exist,
+    so the first few requests still bring variety, and after that a random stored
+    variant is served without any model call. The least recently used names are
+    evicted, icons included, once more than `max_entries` are stored.
+    """
+
+    def __init__(self, directory=CATALOG_DIR, variants=1, max_entries=500):
+        self.directory = directory
+        self.image_dir = os.path.join(directory, 'images')
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock_path = os.path.join(directory, 'index.lock')
+        self.variants = variants
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except ValueError as e:
+                print(f"Ignoring unreadable item catalog {self.index_path}: {e}")
+
+    def lookup(self, name):
+        """Return a stored {'name', 'description', 'image'} variant, or None if the item should be generated."""
+        key = normalize_name(name)
+        with self._lock:
+            entry = self.entries.get(key)
+            stored = []
+            if entry:
+                stored = [variant for variant in entry['variants']
+                          if os.path.exists(os.path.join(self.image_dir, variant['image']))]
+                entry['variants'] = stored
+            if len(stored) < max(self.variants, 1):
+                self.misses += 1
+                telemetry.count('catalog.misses')
+                return None
+            entry['last_used'] = time.time()
+            self.hits += 1
+            telemetry.count('catalog.hits')
+            variant = random.choice(stored)
+        return dict(variant, image=os.path.join(self.image_dir, variant['image']))
+
+    def store(self, name, item_name, description, image_path):
+        """Add a freshly generated item under the requested name and persist the catalog."""
+        if not image_path or not os.path.exists(image_path):
+            return
+        os.makedirs(self.image_dir, exist_ok=True)
+        with open(image_path, 'rb') as f:
+            image = hashlib.sha256(f.read()).hexdigest() + '.png'
+        stored = os.path.join(self.image_dir, image)
+        if not os.path.exists(stored):
+            shutil.copyfile(image_path, stored)
+        key = normalize_name(name)
+        with self._lock:
+            entry = self.entries.setdefault(key, {'variants': [], 'last_used': 0})
+            if not any(variant['image'] == image for variant in entry['variants']):
+                entry['variants'].append({'name': item_name, 'description': description, 'image': image})
+                entry['variants'] = entry['variants'][-max(self.variants, 1):]
+            entry['last_used'] = time.time()
+        self.save()
+
+    def _evict(self):
+        if len(self.entries) <= self.max_entries:
+            return
+        by_age = sorted(self.entries, key=lambda key: self.entries[key]['last_used'])
+        evicted = set()
+        for key in by_age[:len(self.entries) - self.max_entries]:
+            evicted.update(variant['image'] for variant in self.entries.pop(key)['variants'])
+        # Icons are content-addressed and may be shared, so only delete unreferenced ones
+        referenced = {variant['image'] for entry in self.entries.values() for variant in entry['variants']}
+        for image in evicted - referenced:
+            path = os.path.join(self.image_dir, image)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def save(self):
+        """Persist the index, first merging in entries other processes have written since it was loaded."""
+        # Read, merge and write under one inter-process lock, or concurrent saves drop each other's entries
+        with _file_lock(self.lock_path):
+            self._merge_and_write()
+
+    def _merge_and_write(self):
+        on_disk = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, encoding='utf-8') as f:
+                    on_disk = json.load(f)
+            except ValueError:
+                pass
+        with self._lock:
+            for key, entry in on_disk.items():
+                mine = self.entries.get(key)
+                if mine is None:
+                    self.entries[key] = entry
+                    continue
+                known = {variant['image'] for variant in mine['variants']}
+                mine['variants'] = (mine['variants'] + [variant for variant in entry['variants']
+                                                        if variant['image'] not in known])[-max(self.variants, 1):]
+                mine['last_used'] = max(mine['last_used'], entry['last_used'])
+            self._evict()
+            snapshot = json.loads(json.dumps(self.entries))
+        write_json_atomic(self.index_path, snapshot)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def _store_unique(directory, worker, count):
+    """Self-check worker: store `count` names of its own, each with a distinct icon."""
+    catalog = ItemCatalog(directory)
+    source = os.path.join(directory, f'source_{worker}.png')
+    for index in range(count):
+        with open(source, 'wb') as f:
+            f.write(f'{worker}:{index}'.encode())
+        catalog.store(f'item {worker} {index}', f'Item {worker} {index}', 'self-check', source)
+    os.remove(source)
+
+
+def self_check(processes=6, names=40):
+    """Several processes store into one catalog at once; every entry and icon must survive."""
+    with tempfile.TemporaryDirectory() as directory:
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=_store_unique, args=(directory, worker, names)) for worker in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        catalog = ItemCatalog(directory, max_entries=processes * names)
+        referenced = {variant['image'] for entry in catalog.entries.values() for variant in entry['variants']}
+        return {
+            'expected': processes * names,
+            'entries': len(catalog),
+            'images': len(os.listdir(catalog.image_dir)),
+            'unreferenced_images': len(set(os.listdir(catalog.image_dir)) - referenced),
+            'ok': len(catalog) == processes * names == len(referenced) == len(os.listdir(catalog.image_dir)),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Item catalog maintenance.')
+    parser.add_argument('--self-check', action='store_true',
+                        help='check that concurrent processes storing into one catalog lose nothing')
+    parser.add_argument('--processes', type=int, default=6)
+    parser.add_argument('--names', type=int, default=40, help='unique names stored per process')
+    args = parser.parse_args(argv)
+    if args.self_check:
+        result = self_check(args.processes, args.names)
+        print(json.dumps(result, indent=2))
+        return 0 if result['ok'] else 1
+    parser.print_help()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
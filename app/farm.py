@@ -0,0 +1,218 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+# Headless: the SDL dummy drivers must be selected before pygame is imported anywhere
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import telemetry
+from bench import summarize
+
+# Runs many self-play games at once, for load-testing the inference path at realistic
+# concurrency and for filling the item catalog and starter pool overnight. Sessions
+# run in a pool of processes; with a shared backend every process is a client of one
+# InferenceWorker, so the models are loaded once and requests queue as they would
+# with several players on one machine.
+
+_backend = None
+
+
+def _init_process(spec, clients, slots):
+    """Pool process initializer: claim a worker client, or load a private backend."""
+    global _backend
+    if clients:
+        _backend = clients[slots.get()]
+    else:
+        from llm import load_backend
+        _backend = load_backend(spec)
+
+
+def play_session(session_id, seed, turns, catalog_dir=None, item_variants=1, starter_dir=None):
+    """Play one game from its starting inventory for `turns` self-play turns; returns plain-data results."""
+    import random
+
+    import llm
+
+    random.seed(seed)
+    # Only a private stub can be reseeded. A shared worker interleaves every session's
+    # requests and local models sample from fresh seeds, so there the seed is reported as None
+    seeded = hasattr(_backend, 'configure')
+    if seeded:
+        _backend.configure(seed, _backend.text_latency, _backend.image_latency)
+    catalog = None
+    if catalog_dir:
+        from catalog import ItemCatalog
+        catalog = ItemCatalog(catalog_dir, variants=item_variants)
+    game_engine = llm.TextGameEngine(api_comms=llm.APICommunication(backend=_backend))
+    inventory_engine = llm.InventoryEngine(game_engine.api_comms, 6, catalog=catalog)
+    game_engine.inventory_engine = inventory_engine
+
+    result = {'session': session_id, 'seed': seed if seeded else None, 'pid': os.getpid(), 'failures': 0, 'turn_seconds': []}
+    session_start = time.perf_counter()
+    start = time.perf_counter()
+    try:
+        start_items = inventory_engine.get_start_items()
+    except (SyntaxError, ValueError) as e:
+        print(f"Session {session_id}: unparseable starter inventory: {e}")
+        start_items = []
+    result['start_items_seconds'] = time.perf_counter() - start
+    for item in start_items:
+        inventory_engine.add_item(llm.InventoryItem(item['name'], item['description'], item['image']))
+    if starter_dir and start_items:
+        from session import StarterPool
+        StarterPool(starter_dir).add(start_items)
+
+    for _ in range(turns):
+        start = time.perf_counter()
+        try:
+            game_engine.add_user_message(game_engine.self_play())
+            answer, image_path, score = game_engine.generate_response()
+        except llm.InferenceFailed as e:
+            print(f"Session {session_id}: {e}")
+            answer = None
+        result['turn_seconds'].append(time.perf_counter() - start)
+        result['failures'] += answer is None
+    result['seconds'] = time.perf_counter() - session_start
+    result['history_messages'] = len(game_engine.messages)
+    if catalog is not None:
+        result['catalog'] = {'hits': catalog.hits, 'misses': catalog.misses}
+    telemetry.flush()
+    return result
+
+
+def run_farm(args):
+    """Run args.sessions games on args.processes processes and return the report."""
+    context = multiprocessing.get_context('spawn')
+    spec = args.backend
+    shared = args.shared or spec == 'local' or spec.startswith('worker')
+    if spec.startswith('worker'):
+        spec = spec.partition(':')[2] or 'local'
+    if args.stub_text_latency is not None:
+        os.environ['KALANDOR_STUB_TEXT_LATENCY'] = str(args.stub_text_latency)
+    if args.stub_image_latency is not None:
+        os.environ['KALANDOR_STUB_IMAGE_LATENCY'] = str(args.stub_image_latency)
+
+    worker = None
+    clients = []
+    slots = None
+    start = time.perf_counter()
+    if shared:
+        from worker import InferenceWorker
+        worker = InferenceWorker(spec, clients=args.processes).start()
+        worker.supervise()
+        # Pool processes resend when the shared restart counter moves; the timeout is a last resort
+        clients = [worker.client(index, timeout=args.request_timeout) for index in range(args.processes)]
+        slots = context.Queue()
+        for index in range(args.processes):
+            slots.put(index)
+        print("Shared backend: sessions are not reseeded, runs are not reproducible")
+    backend_seconds = time.perf_counter() - start
+
+    results = []
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(args.processes, mp_context=context, initializer=_init_process,
+                                 initargs=(spec, clients, slots)) as pool:
+            futures = [pool.submit(play_session, index, args.seed + index, args.turns,
+                                   args.catalog, args.item_variants, args.starters)
+                       for index in range(args.sessions)]
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Session failed: {e!r}")
+                    results.append({'error': repr(e)})
+                    continue
+                print(f"Session {result['session']} done: {len(result['turn_seconds'])} turns,"
+                      f" {result['failures']} failed, {result['seconds']:.1f}s")
+                results.append(result)
+    finally:
+        if worker is not None:
+            worker.stop()
+    wall = time.perf_counter() - start
+
+    finished = [result for result in results if 'error' not in result]
+    turn_seconds = [seconds for result in finished for seconds in result['turn_seconds']]
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'backend': args.backend,
+            'shared_backend': shared,
+            'sessions': args.sessions,
+            'processes': args.processes,
+            'turns': args.turns,
+            'seed': args.seed,
+            # False when the backend ignores seeds (shared worker, local models): runs are not reproducible
+            'seeded': bool(finished) and all(result['seed'] is not None for result in finished),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'backend_start_ms': backend_seconds * 1000,
+        'wall_seconds': wall,
+        'throughput': {
+            'turns_per_second': len(turn_seconds) / wall if wall else 0.0,
+            'sessions_per_second': len(finished) / wall if wall else 0.0,
+        },
+        'turn': summarize(turn_seconds),
+        'start_items': summarize([result['start_items_seconds'] for result in finished]),
+        'session': summarize([result['seconds'] for result in finished]),
+        'failures': {
+            'turns': sum(result['failures'] for result in finished),
+            'sessions': len(results) - len(finished),
+        },
+        'sessions_detail': sorted(finished, key=lambda result: result['session']),
+    }
+    if worker is not None:
+        report['worker_restarts'] = worker.restarts
+    if args.catalog:
+        from catalog import ItemCatalog
+        report['catalog'] = {
+            'hits': sum(result['catalog']['hits'] for result in finished),
+            'misses': sum(result['catalog']['misses'] for result in finished),
+            'entries': len(ItemCatalog(args.catalog)),
+        }
+    if args.starters:
+        from session import StarterPool
+        report['starter_packs'] = len(StarterPool(args.starters))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run many headless self-play games at once to load-test inference or warm caches.')
+    parser.add_argument('--backend', default='stub',
+                        help="'stub', 'local', 'worker:<spec>', 'replay:<archive>' or an importable backend module")
+    parser.add_argument('--shared', action='store_true',
+                        help="serve every process from one worker (always the case for 'local' and 'worker:')")
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--turns', type=int, default=10, help='self-play turns per session')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='session i uses seed + i; only a private stub backend makes runs reproducible')
+    parser.add_argument('--stub-text-latency', type=float)
+    parser.add_argument('--stub-image-latency', type=float)
+    parser.add_argument('--request-timeout', type=float, default=3600.0,
+                        help='last-resort resend of a shared-backend request after this many seconds, queueing included')
+    parser.add_argument('--catalog', metavar='DIR', help='serve and store items through this item catalog')
+    parser.add_argument('--item-variants', type=int, default=1)
+    parser.add_argument('--starters', metavar='DIR', help="add every session's starting inventory to this starter pool")
+    parser.add_argument('--output', default='farm_report.json')
+    args = parser.parse_args(argv)
+
+    report = run_farm(args)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"{report['throughput']['turns_per_second']:.2f} turns/s,"
+          f" turn p50 {report['turn'].get('p50_ms', 0):.0f} ms, p95 {report['turn'].get('p95_ms', 0):.0f} ms")
+    print(f'Report written to {args.output}')
+    return 1 if report['failures']['sessions'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,55 @@
 import gc
+import json
 import secrets
+import sys
+import time
 
 import torch
-from transformers import pipeline, AutoModelForCausalLM, AutoTokenizer
+from transformers import pipeline, AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList
 from diffusers import DiffusionPipeline, LCMScheduler, StableDiffusionXLPipeline, AutoPipelineForText2Image
 import os
+
+import telemetry
 os.makedirs('temp', exist_ok=True)
+# KALANDOR_DEVICE selects the execution profile: 'cuda', 'cpu' or 'auto' (cuda when available)
+device = os.environ.get('KALANDOR_DEVICE', 'auto')
+if device == 'auto':
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+image_steps = 7
+image_dtype = torch.float16
+if device == 'cpu':
+    # Intra-op threads drive the large matmuls and convolutions; a couple of inter-op
+    # threads is enough since both models are mostly one long chain of ops
+    torch.set_num_threads(int(os.environ.get('KALANDOR_CPU_THREADS', os.cpu_count() or 1)))
+    torch.set_num_interop_threads(int(os.environ.get('KALANDOR_CPU_INTEROP_THREADS', 2)))
+    image_steps = int(os.environ.get('KALANDOR_CPU_IMAGE_STEPS', 4))
+    image_dtype = torch.float32
+    try:
+        if torch.ops.mkldnn._is_mkldnn_bf16_supported():
+            image_dtype = torch.bfloat16
+    except (AttributeError, RuntimeError):
+        pass
+    if os.environ.get('KALANDOR_CPU_IMAGE_DTYPE'):
+        image_dtype = getattr(torch, os.environ['KALANDOR_CPU_IMAGE_DTYPE'])
 model_name="microsoft/Phi-3-mini-128k-instruct"
 # model_name="mistralai/Mistral-7B-Instruct-v0.2"
 # Load the models and tokenizer
-model = AutoModelForCausalLM.from_pretrained(
-    model_name,
-    device_map="cuda",
-    torch_dtype="auto",
-    trust_remote_code=True,
-)
+if device == 'cuda':
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        device_map="cuda",
+        torch_dtype="auto",
+        trust_remote_code=True,
+    )
+else:
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch.float32,
+        trust_remote_code=True,
+    )
+    # Dynamic int8 quantization of every Linear layer (attention and MLP projections, lm_head)
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    model.eval()
 tokenizer = AutoTokenizer.from_pretrained(model_name)
 text_pipe = pipeline(
     "text-generation",
@@ -25,7 +60,7 @@ text_pipe = pipeline(
 #                                                     torch_dtype=torch.float16).to('cuda')
 
 image_pipe = AutoPipelineForText2Image.from_pretrained('PublicPrompts/All-In-One-Pixel-Model',
-                                                    torch_dtype=torch.float16).to('cuda')
+                                                    torch_dtype=image_dtype).to(device)
 image_pipe.safety_checker = None
 # set scheduler
 image_pipe.scheduler = LCMScheduler.from_config(image_pipe.scheduler.config)
@@ -33,10 +68,17 @@ image_pipe.scheduler = LCMScheduler.from_config(image_pipe.scheduler.config)
 # load LCM-LoRA
 image_pipe.load_lora_weights("latent-consistency/lcm-lora-sdv1-5")
 image_pipe.fuse_lora()
+if device == 'cpu':
+    # oneDNN convolutions are fastest on NHWC tensors
+    image_pipe.unet.to(memory_format=torch.channels_last)
+    image_pipe.vae.to(memory_format=torch.channels_last)
+    image_pipe.set_progress_bar_config(disable=True)
 
 
 def optimize():
     global image_pipe
+    if device != 'cuda':
+        return
     try:
         from sfast.compilers.diffusion_pipeline_compiler import (
             compile,
@@ -73,8 +115,36 @@ def optimize():
     except:
         pass
 
+class _DecodeTimer(StoppingCriteria):
+    """Never stops generation; notes when the first token is out and counts the decode steps."""
+
+    def __init__(self):
+        self.first_token = None
+        self.steps = 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.steps += 1
+        return False
+
+
+class _Cancelled(StoppingCriteria):
+    """Ends decoding as soon as the (speculative) turn the request belongs to is cancelled."""
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+# APICommunication passes its cancel event to generate_text(), which stops mid-decode
+cancellable = True
+
+
 @torch.inference_mode()
-def generate_text(prompt):
+def generate_text(prompt, cancel_event=None):
     # try:
     torch.manual_seed(secrets.randbelow(9999999999))
     generation_args = {
@@ -83,28 +153,99 @@ def generate_text(prompt):
         "temperature": 0.75,
         "do_sample": True,
     }
+    stopping = [_Cancelled(cancel_event)] if cancel_event is not None else []
+    if stopping:
+        generation_args["stopping_criteria"] = StoppingCriteriaList(stopping)
+    if not telemetry.enabled:
+        response = text_pipe(prompt, **generation_args)
+        return response[0]['generated_text']
+    # Traced runs go through the same pipeline call; tokenization is timed on its own
+    # beforehand and a stopping criterion marks where prefill ends and decode begins
+    with telemetry.span('inference.tokenize') as span:
+        prompt_tokens = len(tokenizer.apply_chat_template(prompt, add_generation_prompt=True))
+        span.set(tokens=prompt_tokens)
+    timer = _DecodeTimer()
+    start = time.perf_counter()
+    generation_args["stopping_criteria"] = StoppingCriteriaList([timer] + stopping)
     response = text_pipe(prompt, **generation_args)
+    end = time.perf_counter()
+    first_token = timer.first_token or end
+    # Prefill includes the pipeline's own preprocessing, decode its detokenization
+    telemetry.record('inference.prefill', (first_token - start) * 1000, tokens=prompt_tokens)
+    telemetry.record('inference.decode', (end - first_token) * 1000, tokens=timer.steps)
+    telemetry.count('inference.prompt_tokens', prompt_tokens)
+    telemetry.count('inference.generated_tokens', timer.steps)
     return response[0]['generated_text']
     # except Exception as e:
     #     return "fail"
 def cleanup():
     gc.collect()
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
+    if device == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
 @torch.inference_mode()
+def render_image(prompt):
+    """Run diffusion only and return the PIL image."""
+    with telemetry.span('inference.diffusion', steps=image_steps):
+        return image_pipe(prompt=prompt, guidance_scale=1.0, num_inference_steps=image_steps).images[0]
+def save_image(image, prompt):
+    image_path = f"temp/{hash(prompt)}.png"
+    with telemetry.span('inference.png_save'):
+        image.save(image_path, "PNG")
+    return image_path
 def generate_image(prompt):
     try:
-        image = image_pipe(prompt=prompt, guidance_scale=1.0, num_inference_steps=7).images[0]
-        image_path = f"temp/{hash(prompt)}.png"
-        image.save(image_path, "PNG")
-        cleanup()
+        image = render_image(prompt)
+        image_path = save_image(image, prompt)
+        with telemetry.span('inference.cleanup'):
+            cleanup()
         return image_path
     except Exception as e:
+        telemetry.count('inference.image_failures')
         print("IMAGE INFERENCE FAILED")
 
 def count_tokens(prompts):
     # Check token count before adding new user message
     summed = 0
-    for i in [tokenizer.encode(message['content']) for message in prompts]:
-        summed += len(i)
-    return summed
\ No newline at end of file
+    with telemetry.span('inference.count_tokens', messages=len(prompts)):
+        for i in [tokenizer.encode(message['content']) for message in prompts]:
+            summed += len(i)
+    return summed
+
+
+@torch.inference_mode()
+def self_check(text_tokens=64, images=2):
+    """Short fixed-length generation and diffusion runs reporting throughput of the active profile."""
+    prompt = [{'role': 'user', 'content': 'Describe a torch-lit dungeon corridor.'}]
+    input_ids = tokenizer.apply_chat_template(prompt, add_generation_prompt=True, return_tensors="pt").to(model.device)
+    generation_args = {
+        "attention_mask": torch.ones_like(input_ids),
+        "do_sample": False,
+        "pad_token_id": tokenizer.eos_token_id,
+    }
+    model.generate(input_ids, max_new_tokens=4, **generation_args)  # warm-up
+    start = time.perf_counter()
+    output = model.generate(input_ids, max_new_tokens=text_tokens, min_new_tokens=text_tokens, **generation_args)
+    text_time = time.perf_counter() - start
+    generated = output.shape[-1] - input_ids.shape[-1]
+
+    image_pipe(prompt='pixel art, torch', guidance_scale=1.0, num_inference_steps=image_steps)  # warm-up
+    start = time.perf_counter()
+    for _ in range(images):
+        image_pipe(prompt='pixel art, torch', guidance_scale=1.0, num_inference_steps=image_steps)
+    image_time = time.perf_counter() - start
+    return {
+        'device': device,
+        'threads': torch.get_num_threads(),
+        'interop_threads': torch.get_num_interop_threads(),
+        'image_dtype': str(image_dtype),
+        'image_steps': image_steps,
+        'tokens_per_sec': generated / text_time,
+        'images_per_sec': images / image_time,
+    }
+
+
+if __name__ == "__main__":
+    # python inference.py --self-check
+    if '--self-check' in sys.argv:
+        print(json.dumps(self_check(), indent=2))
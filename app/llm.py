@@ -1,12 +1,16 @@
 import ast
+import collections
 import gc
+import importlib
 import json
+import os
 import re
 import secrets
+import threading
 
 import pygame
-import torch
-import os
+
+import telemetry
 
 # Define the cache directory path
 cache_dir = os.path.expanduser('~/kalandor/hf_cache')
@@ -23,35 +27,160 @@ reminder = 'I will always answer in the format: {"image":"Description", "answer"
 BG_COLOR = pygame.Color('black')
 TEXT_COLOR = pygame.Color('white')
 BORDER_COLOR = pygame.Color('gray')
-from inference import generate_image, generate_text, count_tokens
+# Backends run one request at a time; the speculative self-play thread and the UI share them
+inference_lock = threading.Lock()
+
+
+# Decoded images by path: the renderer draws the same few images every frame, and the
+# inference worker hands over pixels it has already decoded via register_image()
+_image_cache = collections.OrderedDict()
+_image_lock = threading.Lock()
+IMAGE_CACHE_SIZE = 64
+TOKEN_CACHE_SIZE = 4096
+# Token caches are shared with the speculative self-play thread's APICommunication
+_token_lock = threading.Lock()
+
+
+def register_image(path, surface):
+    with _image_lock:
+        _image_cache[path] = surface
+        _image_cache.move_to_end(path)
+        while len(_image_cache) > IMAGE_CACHE_SIZE:
+            _image_cache.popitem(last=False)
+
+
+def load_image(path):
+    """pygame.image.load() with a small LRU cache in front of it."""
+    with _image_lock:
+        surface = _image_cache.get(path)
+        if surface is not None:
+            _image_cache.move_to_end(path)
+            return surface
+    surface = pygame.image.load(path)
+    register_image(path, surface)
+    return surface
+
+
+class TurnCancelled(Exception):
+    """Raised inside a cancelled speculative turn before it reaches the backend again."""
+
+
+class InferenceFailed(RuntimeError):
+    """The backend cannot answer: text kept failing, or its worker process gave up."""
+
+
+# 'fail' responses are retried this often before the turn is given up
+TEXT_ATTEMPTS = 3
+
+
+def load_backend(spec='local'):
+    """Resolve an inference backend: 'local' (inference.py), 'stub', 'replay:<archive>',
+    'worker[:<spec>]' (another backend in a supervised process) or any importable module name."""
+    name, _, arg = spec.partition(':')
+    if name == 'local':
+        return importlib.import_module('inference')
+    if name == 'stub':
+        return importlib.import_module('stub_backend')
+    if name == 'replay':
+        from replay import ReplayBackend
+        return ReplayBackend(arg)
+    if name == 'worker':
+        from worker import InferenceWorker
+        worker = InferenceWorker(arg or 'local')
+        worker.start()
+        worker.supervise()
+        # The client keeps the handle as .worker; whoever loaded it calls worker.stop() on exit
+        return worker.client()
+    return importlib.import_module(name)
 
 
-def cleanup():
-    gc.collect()
-    torch.cuda.empty_cache()
-    torch.cuda.ipc_collect()
 class APICommunication:
-    def __init__(self, base_url="http://localhost:8000"):
+    def __init__(self, base_url="http://localhost:8000", backend=None, cancel_event=None, token_counts=None):
         self.base_url = base_url
+        self._backend = backend
+        self.cancel_event = cancel_event
+        # Token count per message content: stored history and the static system prompt
+        # are tokenized once instead of on every request
+        self.token_counts = collections.OrderedDict() if token_counts is None else token_counts
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise TurnCancelled()
+
+    @property
+    def backend(self):
+        # The local models are only loaded when the first request needs them
+        if self._backend is None:
+            self._backend = load_backend()
+        return self._backend
+
+    def cleanup(self):
+        with telemetry.span('api.cleanup'):
+            cleanup = getattr(self.backend, 'cleanup', None)
+            if cleanup is not None:
+                with inference_lock:
+                    cleanup()
+            else:
+                gc.collect()
+
+    def count_tokens(self, prompts):
+        with telemetry.span('api.count_tokens', messages=len(prompts)):
+            total = 0
+            for message in prompts:
+                content = message['content']
+                with _token_lock:
+                    count = self.token_counts.get(content)
+                    if count is not None:
+                        self.token_counts.move_to_end(content)
+                if count is None:
+                    with inference_lock:
+                        count = self.backend.count_tokens([message])
+                    with _token_lock:
+                        self.token_counts[content] = count
+                        if len(self.token_counts) > TOKEN_CACHE_SIZE:
+                            self.token_counts.popitem(last=False)
+                    telemetry.count('api.token_cache_misses')
+                total += count
+            return total
 
     def generate_text(self, prompt, max_tokens, summary={'role':'user', 'content':'Summary of previous events'}):
-        """Generates text based on the prompt, retrying until a successful response is obtained."""
+        """Generates text based on the prompt, retrying failed responses up to TEXT_ATTEMPTS times."""
         response = None
-        while response is None or response == 'fail':
-            token_sum = count_tokens(prompt)
-
-            if token_sum > 126000:
-                prompt = [prompt[0], summary, prompt[-1]]
-
-            response = generate_text(prompt)  # Assuming generate_text is a callable that returns the response
-            if response == 'fail':
-                print("Failed to generate text, retrying...")
-            cleanup()  # Ensure resources are cleaned or reset between retries
+        with telemetry.span('api.generate_text') as span:
+            attempts = 0
+            while response is None or response == 'fail':
+                attempts += 1
+                token_sum = self.count_tokens(prompt)
+
+                if token_sum > 126000:
+                    prompt = [prompt[0], summary, prompt[-1]]
+                    telemetry.count('api.truncations')
+
+                with inference_lock:
+                    self.check_cancelled()
+                    if self.cancel_event is not None and getattr(self.backend, 'cancellable', False):
+                        # Lets the local model stop decoding instead of holding the lock until it is done
+                        response = self.backend.generate_text(prompt, cancel_event=self.cancel_event)
+                    else:
+                        response = self.backend.generate_text(prompt)
+                    self.check_cancelled()  # A cut-off response must not be used
+                if response == 'fail':
+                    if attempts == TEXT_ATTEMPTS:
+                        raise InferenceFailed(f"Text generation failed {attempts} times")
+                    print("Failed to generate text, retrying...")
+                    telemetry.count('api.retries')
+                self.cleanup()  # Ensure resources are cleaned or reset between retries
+            span.set(prompt_tokens=token_sum, attempts=attempts)
         return response
 
     def generate_image(self, prompt):
-        response = generate_image(prompt)
-        cleanup()
+        with telemetry.span('api.generate_image'):
+            with inference_lock:
+                self.check_cancelled()
+                response = self.backend.generate_image(prompt)
+            if response is None:
+                telemetry.count('api.image_failures')
+            self.cleanup()
         return response
 
 class InventoryItem:
@@ -59,13 +188,14 @@ class InventoryItem:
         self.name = name
         self.description = description
         self.image_path = image_path
-        self.image = pygame.image.load(image_path)
+        self.image = load_image(image_path)
         self.slot_rect = None  # Add this to store the rectangle
 class InventoryEngine:
 
-    def __init__(self, api, max_slots):
+    def __init__(self, api, max_slots, catalog=None):
         self.items = []
         self.api = api
+        self.catalog = catalog  # Optional ItemCatalog serving previously generated items
         self.inventory = None
         self.max_slots = max_slots
         self.rows = 2
@@ -105,6 +235,10 @@ class InventoryEngine:
         return None, None, None
 
     def generate_single_item(self, item):
+        if self.catalog is not None:
+            cached = self.catalog.lookup(item)
+            if cached:
+                return InventoryItem(cached['name'], cached['description'], cached['image'])
         # Create a message prompting the generation of a single item
         messages = [
             {'role': 'system',
@@ -118,17 +252,22 @@ class InventoryEngine:
         response = self.generate_response(messages)
         try:
             # Parse the response from the language model
-            item_data = ast.literal_eval(response)
+            with telemetry.span('engine.parse', source='item'):
+                item_data = ast.literal_eval(response)
             item_name = item_data['name']
             item_description = item_data['description']
             filename = self.generate_image('pixel art, ' + item_description)
+            if self.catalog is not None:
+                self.catalog.store(item, item_name, item_description, filename)
             return InventoryItem(item_name, item_description, filename)
         except SyntaxError as e:
+            telemetry.count('engine.parse_errors')
             print(f"Error parsing LLM response: {str(e)}")
             print(f"LLM response was: {response}")
             return None
 
-    def get_start_items(self):
+    def get_start_items(self, progress=None):
+        """progress, if given, is called as progress(done, total) after each item's icon is ready."""
 
         messages = [
             {'role': 'system',
@@ -138,12 +277,21 @@ class InventoryEngine:
              'content': f'Generate the starting list of objects'},
         ]
         starting_items = self.generate_response(messages)
-        starting_items = ast.literal_eval(starting_items)
+        with telemetry.span('engine.parse', source='start_items'):
+            starting_items = ast.literal_eval(starting_items)
         counter = 0
         for i in starting_items:
-            filename = self.generate_image(i.get('description', 'game inventory item'))
-            i['image'] = filename
+            cached = self.catalog.lookup(i.get('name', '')) if self.catalog is not None else None
+            if cached:
+                i.update(cached)
+            else:
+                filename = self.generate_image(i.get('description', 'game inventory item'))
+                i['image'] = filename
+                if self.catalog is not None:
+                    self.catalog.store(i.get('name', ''), i.get('name', ''), i.get('description', ''), filename)
             counter += 1
+            if progress is not None:
+                progress(counter, len(starting_items))
         return starting_items
 
     def use_item(self, item, action):
@@ -168,7 +316,8 @@ class InventoryEngine:
                     ]
                     result = self.generate_response(messages)
                     try:
-                        parsed_response = ast.literal_eval(result)
+                        with telemetry.span('engine.parse', source='use_item'):
+                            parsed_response = ast.literal_eval(result)
                         effect = parsed_response['effect']
                         keep_item = parsed_response['keep_item']
 
@@ -179,6 +328,7 @@ class InventoryEngine:
                             print(f"{normalized_item} remains in the inventory after use.")
 
                     except SyntaxError as e:
+                        telemetry.count('engine.parse_errors')
                         print(f"Error parsing LLM response: {str(e)}")
                         print(f"LLM response was: {result}")
                 except:
@@ -204,11 +354,11 @@ def extract_with_nested_braces(text):
                 return text[start:index+1]
     return None
 class TextGameEngine:
-    def __init__(self, max_tokens=128000):
+    def __init__(self, max_tokens=128000, api_comms=None):
         self.max_tokens = max_tokens
         self.messages = [
         ]
-        self.api_comms = APICommunication()
+        self.api_comms = api_comms or APICommunication()
         self.inventory_engine = None
         self.location = ""
         self.summary = ""
@@ -216,28 +366,37 @@ class TextGameEngine:
                          'Choose an action for inventory items: no_action, use_inventory_item, add_to_inventory, remove_from_inventory. '
                          'On request, list the actual inventory. Your "answer" must be immersive, like a role playing game master.'
                          'Respond with the next scenario formatted as: {"image":"Image Description", "answer":"Adventure content and next question", "score":-10-10, "action":"choose from above", "item":"[no_items or item names]", "location":"Current Location"}')
+        # Static part of the system prompt; the game state is only added to outgoing requests
+        self.system_prompt = (
+            'I am a sentient AGI Role Playing assistant tasked with maintaining a consistent game environment and narrative flow. '
+            'I will score user actions based on their relevance and effectiveness within the current environment. '
+            'I ensure that all interactions with objects are realistic and adhere to the environment. '
+            'Choices regarding the usage of inventory items must be context-sensitive, ensuring no random environment shifts unless narratively justified. '
+            'I will always provide an action choice from: no_action, use_inventory_item, add_to_inventory, remove_from_inventory. '
+            'I must respond with the next scenario formatted as: {"image":"portrait of a sorcerer, highly detailed, photorealistic", "answer":"Adventure content and next question", "score":-10-10, "action":"no_action", "item":"[no_items]", "location":"Current Location"}')
         self.alter_system_message()
-    def alter_system_message(self, location='Unknown', inventory='Empty', summary="None"):
+    def alter_system_message(self, location='Unknown', summary="None"):
         # Update class attributes to reflect current game state
         self.location = location
         self.summary = summary
 
-        # Update the system message to reflect current game state
-        content = (
-            f'I am a sentient AGI Role Playing assistant tasked with maintaining a consistent game environment and narrative flow. '
-            f'I will score user actions based on their relevance and effectiveness within the current environment. '
-            f'I ensure that all interactions with objects are realistic and adhere to the environment. '
-            f'Choices regarding the usage of inventory items must be context-sensitive, ensuring no random environment shifts unless narratively justified. '
-            f'The current location is {location}, your inventory contains: {inventory}, the current situation is: {summary}. '
-            'I will always provide an action choice from: no_action, use_inventory_item, add_to_inventory, remove_from_inventory. '
-            'I must respond with the next scenario formatted as: {"image":"portrait of a sorcerer, highly detailed, photorealistic", "answer":"Adventure content and next question", "score":-10-10, "action":"no_action", "item":"[no_items]", "location":"Current Location"}')
-
+        # The stored system message stays static so its tokens are counted once and every
+        # request shares the same prefix; build_prompt() adds the state per request
+        content = self.system_prompt
         if not self.messages:
             self.messages.append({'role': 'system', 'content': content})
         else:
             self.messages[0] = {'role': 'system', 'content': content}
         self.initial_message = self.messages[0]
 
+    def build_prompt(self):
+        """Stored history plus the current state and reminder, added to the outgoing copy of the last message only."""
+        inventory = self.inventory_engine.get_current_items() if self.inventory_engine else []
+        state = (f" The current location is {self.location or 'Unknown'}, our inventory contains: {inventory or 'Empty'},"
+                 f" the current situation is: {self.summary or 'None'}. ")
+        last = self.messages[-1]
+        return self.messages[:-1] + [{'role': last['role'], 'content': last['content'] + state + self.reminder}]
+
     def self_play(self):
         """Generate user input based on previous events and the current scenario."""
         # Fetch the current scenario as context
@@ -256,7 +415,8 @@ class TextGameEngine:
                         ' You must answer with a single string emualating the next user input.'
         }]
 
-        response = self.api_comms.generate_text(synthetic_user_input, 1024)
+        with telemetry.span('engine.self_play'):
+            response = self.api_comms.generate_text(synthetic_user_input, 1024)
         #
         print(response)
         # parsed = ast.literal_eval(response)
@@ -268,31 +428,36 @@ class TextGameEngine:
         # Proceed to generate the system's response to the synthetic user input
         return self.generate_response()
     def generate_response(self):
-        try:
-            self.messages[-1]['content'] = self.messages[-1]['content'] + f" We are currently in {self.location} and our inventory contains: {self.inventory_engine.get_current_items()} " + self.reminder
-            generated_text = self.api_comms.generate_text(self.messages, 1024, summary={'role':'user', 'content':self.summary})
-
-            if count_tokens(self.messages) > 126000:
-                self.reset_conversation(self.summary)
-
-            print(generated_text)
-            self.messages.append({'role': 'system', 'content': generated_text})
-            parsed = ast.literal_eval(generated_text)
-            action = parsed.get('action', 'no_action')
-            item = parsed.get('item', 'no_item')
-            score = int(parsed.get('score', 0))
-            if action:
-                self.handle_inventory_action(action, item)
-            image = self.api_comms.generate_image(prompt=parsed['image'])
-
-
-            answer = parsed.get('answer', parsed['image'])
-            self.location = parsed.get('location', self.location)
-            self.alter_system_message(self.location, self.inventory_engine.get_current_items(), self.summary)
-            return answer, image, score
-        except Exception as e:
-            print(repr(e))
-            return None, None, None
+        with telemetry.span('engine.turn'):
+            try:
+                generated_text = self.api_comms.generate_text(self.build_prompt(), 1024, summary={'role':'user', 'content':self.summary})
+
+                if self.api_comms.count_tokens(self.messages) > 126000:
+                    self.reset_conversation(self.summary)
+
+                print(generated_text)
+                self.messages.append({'role': 'system', 'content': generated_text})
+                with telemetry.span('engine.parse', source='scenario'):
+                    parsed = ast.literal_eval(generated_text)
+                action = parsed.get('action', 'no_action')
+                item = parsed.get('item', 'no_item')
+                score = int(parsed.get('score', 0))
+                if action:
+                    with telemetry.span('engine.inventory_action', action=action):
+                        self.handle_inventory_action(action, item)
+                image = self.api_comms.generate_image(prompt=parsed['image'])
+
+
+                answer = parsed.get('answer', parsed['image'])
+                self.location = parsed.get('location', self.location)
+                self.alter_system_message(self.location, self.summary)
+                return answer, image, score
+            except TurnCancelled:
+                raise
+            except Exception as e:
+                telemetry.count('engine.turn_failures')
+                print(repr(e))
+                return None, None, None
 
     def handle_inventory_action(self, action, item_name):
         if action == 'add_to_inventory':
@@ -306,6 +471,27 @@ class TextGameEngine:
             self.inventory_engine.use_item(item_name, summary)
     def add_user_message(self, user_message):
         self.messages.append({'role': 'user', 'content': user_message})
+    def get_state(self):
+        """Plain-data copy of everything needed to continue this game later."""
+        items = self.inventory_engine.items if self.inventory_engine else []
+        return {
+            'messages': [dict(message) for message in self.messages],
+            'location': self.location,
+            'summary': self.summary,
+            # Absolute, since the game may be resumed from another working directory
+            'inventory': [{'name': item.name, 'description': item.description,
+                           'image': os.path.abspath(item.image_path) if item.image_path else None} for item in items],
+        }
+    def set_state(self, state):
+        self.messages = [dict(message) for message in state['messages']]
+        self.location = state.get('location', '')
+        self.summary = state.get('summary', '')
+        # Snapshots may carry an older system prompt; state lives outside the history now
+        self.alter_system_message(self.location or 'Unknown', summary=self.summary or 'None')
+        if self.inventory_engine:
+            # Items whose icon has been deleted from disk since the snapshot are dropped
+            self.inventory_engine.items = [InventoryItem(item['name'], item['description'], item['image'])
+                                           for item in state.get('inventory', []) if item['image'] and os.path.exists(item['image'])]
     def generate_item_image(self, prompt):
         return self.api_comms.generate_image(prompt)
     def summarize_conversation(self):
@@ -313,11 +499,13 @@ class TextGameEngine:
 
         sums = self.messages.copy()
         sums.append({'role': 'user', 'content': 'Your task is now to conclude the previous happenings in the following format: {"summary":"Summary of all previous events", "location":"Current Location"}'})
-        self.summary = self.api_comms.generate_text(sums, 1024)
+        with telemetry.span('engine.summarize'):
+            self.summary = self.api_comms.generate_text(sums, 1024)
         print("Summary:", self.summary)
         return self.summary
     def reset_conversation(self, summarized_text):
         print("RESET")
+        telemetry.count('engine.resets')
         self.messages = [
             self.initial_message,
             {'role': 'user', 'content': f'Here is a summary of everything that happened so far: {summarized_text}'},
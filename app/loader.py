@@ -0,0 +1,41 @@
+import threading
+
+
+class BackgroundLoader:
+    """Runs a slow startup function on a thread so the window can keep drawing.
+
+    The target is called as target(report) and may call report(message, fraction)
+    at any time; message and fraction (0-1, or None when unknown) are read by the
+    UI every frame. get() returns the target's result or re-raises its exception.
+    """
+
+    def __init__(self, target):
+        self.message = 'Starting'
+        self.fraction = None
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(target,), daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def report(self, message, fraction=None):
+        self.message = message
+        self.fraction = fraction
+
+    def _run(self, target):
+        try:
+            self._result = target(self.report)
+        except BaseException as e:
+            self._error = e
+
+    @property
+    def done(self):
+        return not self._thread.is_alive()
+
+    def get(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
@@ -1,8 +1,15 @@
+import os
 import pygame
 import sys
+import time
 
 from pygame.locals import *
-from llm import TextGameEngine, InventoryEngine, InventoryItem
+import telemetry
+from llm import APICommunication, InferenceFailed, TextGameEngine, InventoryEngine, InventoryItem, load_backend, load_image
+from catalog import CATALOG_DIR, ItemCatalog
+from session import SESSION_PATH, STARTER_DIR, StarterPool, load_session, save_session
+from loader import BackgroundLoader
+from speculative import SpeculativeTurn
 
 # Constants
 FPS = 30
@@ -14,15 +21,22 @@ BORDER_COLOR = pygame.Color('gray')
 BORDER_WIDTH = 4
 FONT_NAME = pygame.font.match_font('courier')  # Monospace font similar to DOS fonts
 
-# Initialize Pygame
-pygame.init()
-info = pygame.display.Info()
-WIDTH, HEIGHT = info.current_w // 2, info.current_h // 2
-screen = pygame.display.set_mode((WIDTH, HEIGHT), RESIZABLE)
-pygame.display.set_caption("Text-based DOS Game")
-clock = pygame.time.Clock()
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
+# The window is opened by init_display() as the first step of main(), not on import,
+# so inference worker processes can import this module without opening one
+WIDTH, HEIGHT = 0, 0
+screen = None
+clock = None
+
+
+def init_display():
+    global WIDTH, HEIGHT, screen, clock
+    # Initialize Pygame
+    pygame.init()
+    info = pygame.display.Info()
+    WIDTH, HEIGHT = info.current_w // 2, info.current_h // 2
+    screen = pygame.display.set_mode((WIDTH, HEIGHT), RESIZABLE)
+    pygame.display.set_caption("Text-based DOS Game")
+    clock = pygame.time.Clock()
 from datetime import datetime
 
 
@@ -83,6 +97,9 @@ def add_to_pdf(c, text, image_path, ypos):
 
 
 def create_pdf_log():
+    # reportlab is only needed once the game is running, keep it off the startup path
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     filename = f"game_log_{timestamp}.pdf"
     c = canvas.Canvas(filename, pagesize=letter)
@@ -156,7 +173,7 @@ def draw_user_input_box(surface, input_text, position, area_width, area_height,
 def show_image(screen, image_path, position, size):
     try:
         # Load the image from the path
-        image = pygame.image.load(image_path)
+        image = load_image(image_path)
 
         # Get the original dimensions of the image
         original_width, original_height = image.get_size()
@@ -229,7 +246,7 @@ import pygame
 def draw_label(surface, name, description, font, position, max_width, image_path):
     try:
         # Load and scale the image
-        image = pygame.image.load(image_path)
+        image = load_image(image_path)
         image_width, image_height = image.get_size()
 
         # Calculate scale to maintain aspect ratio
@@ -291,6 +308,17 @@ def draw_label(surface, name, description, font, position, max_width, image_path
     # Draw border around the card
     pygame.draw.rect(surface, BORDER_COLOR, card_rect, 1)  # Drawing border
 
+def draw_overlay(surface, font):
+    """Draws the latest and mean duration of every telemetry span in the top-left corner."""
+    lines = [f"{name}: {last:.1f} ms (avg {mean:.1f})" for name, (last, mean) in sorted(telemetry.summary().items())]
+    lines += [f"{name}: {value}" for name, value in sorted(telemetry.counters.items())]
+    y = 15
+    for line in lines:
+        line_surface = font.render(line, True, USER_TEXT_COLOR, BG_COLOR)
+        surface.blit(line_surface, (15, y))
+        y += line_surface.get_height()
+
+
 def render_screen(input_text, screen, text_buffer, font, base_y, text_area_width, inventory_engine, inventory_position, inventory_area_size, score, score_position, image_area_width, image_path, image_position, image_size):
     # Clear the screen
     screen.fill(BG_COLOR)
@@ -319,14 +347,100 @@ def render_screen(input_text, screen, text_buffer, font, base_y, text_area_width
 
     # Update the display
     pygame.display.flip()
-def main():
-    global WIDTH, HEIGHT, screen
-    game_engine = TextGameEngine()
-    inventory_engine = InventoryEngine(game_engine.api_comms, 6)
+def draw_loading(surface, font, message, fraction):
+    """Loading screen: the current startup stage and a progress bar (animated when the fraction is unknown)."""
+    surface.fill(BG_COLOR)
+    message_surface = font.render(message, True, TEXT_COLOR)
+    surface.blit(message_surface, message_surface.get_rect(center=(WIDTH // 2, HEIGHT // 2 - font.get_height())))
+    bar_rect = pygame.Rect(WIDTH // 4, HEIGHT // 2 + font.get_height(), WIDTH // 2, font.get_height())
+    if fraction is None:
+        # Bouncing block while the stage gives no progress of its own
+        block_width = bar_rect.width // 5
+        phase = (pygame.time.get_ticks() // 10) % (2 * (bar_rect.width - block_width))
+        offset = phase if phase < bar_rect.width - block_width else 2 * (bar_rect.width - block_width) - phase
+        pygame.draw.rect(surface, USER_TEXT_COLOR, (bar_rect.x + offset, bar_rect.y, block_width, bar_rect.height))
+    else:
+        pygame.draw.rect(surface, USER_TEXT_COLOR, (bar_rect.x, bar_rect.y, int(bar_rect.width * fraction), bar_rect.height))
+    draw_bordered_box(surface, bar_rect, BORDER_COLOR, 1)
+
+
+def load_game(report):
+    """Loads the backend, engines and the starting inventory; runs on the loader thread."""
+    # KALANDOR_BACKEND selects the inference backend, e.g. 'stub' for a run without models
+    # or 'replay:<archive>' to serve a session captured with KALANDOR_RECORD=<archive>
+    # (KALANDOR_RECORD_PROMPTS=1 also archives the full text prompts, for debugging)
+    backend_spec = os.environ.get('KALANDOR_BACKEND', 'local')
+    if backend_spec == 'local':
+        report("Importing torch, transformers and diffusers")
+        import torch, transformers, diffusers  # Split out so the loading screen can tell import from model load
+    report("Loading models")
+    backend = load_backend(backend_spec)
+    # A 'worker:' backend's process and shared memory are released explicitly on exit
+    worker = getattr(backend, 'worker', None)
+    if hasattr(backend, 'latency_scale'):
+        backend.latency_scale = float(os.environ.get('KALANDOR_REPLAY_LATENCY', 0))
+    if os.environ.get('KALANDOR_RECORD'):
+        from replay import RecordingBackend
+        backend = RecordingBackend(backend, os.environ['KALANDOR_RECORD'],
+                                   full_prompts=bool(os.environ.get('KALANDOR_RECORD_PROMPTS')))
+    game_engine = TextGameEngine(api_comms=APICommunication(backend=backend))
+    # KALANDOR_ITEMS points at the item catalog ('' disables it), KALANDOR_ITEM_VARIANTS sets variety per name
+    catalog_dir = os.environ.get('KALANDOR_ITEMS', CATALOG_DIR)
+    catalog = ItemCatalog(catalog_dir, variants=int(os.environ.get('KALANDOR_ITEM_VARIANTS', 1))) if catalog_dir else None
+    inventory_engine = InventoryEngine(game_engine.api_comms, 6, catalog=catalog)
     # inventory = Inventory(6)
     game_engine.inventory_engine = inventory_engine
     # inventory_engine.inventory = inventory
-    start_items = inventory_engine.get_start_items()
+    # Resume the last game if there is a snapshot (KALANDOR_SESSION='' disables it), otherwise
+    # take a pre-generated starter inventory and only fall back to generating one live
+    report("Restoring session")
+    session_path = os.environ.get('KALANDOR_SESSION', SESSION_PATH)
+    session = load_session(session_path, game_engine) if session_path else None
+    if session is None:
+        report("Preparing starter inventory")
+        start_items = StarterPool(os.environ.get('KALANDOR_STARTERS', STARTER_DIR)).draw()
+        if not start_items:
+            try:
+                start_items = inventory_engine.get_start_items(
+                    progress=lambda done, total: report(f"Creating starter items {done}/{total}", done / total))
+            except InferenceFailed:
+                if worker is not None:
+                    worker.stop()
+                raise
+        for item in start_items:
+            inventory_engine.add_item(InventoryItem(item['name'], item['description'], item['image']))
+    return game_engine, inventory_engine, catalog, session_path, session, worker
+
+
+TURN_FAILED = "[The storyteller falters and cannot answer right now. Try again in a moment.]"
+FAILED_TURN_DELAY = 30000  # ms before self-play tries again after a failed turn
+
+
+def snapshot_path(path):
+    """Sessions are resumed from whatever directory the game is launched in, so snapshots store absolute paths."""
+    return os.path.abspath(path) if path else path
+
+
+def main():
+    global WIDTH, HEIGHT, screen
+    init_display()
+    # Show progress in the open window while the models load in the background
+    loader = BackgroundLoader(load_game).start()
+    loading_font = get_font(HEIGHT // 35)
+    while not loader.done:
+        for event in pygame.event.get():
+            if event.type == QUIT:
+                pygame.quit()
+                sys.exit()
+        draw_loading(screen, loading_font, loader.message, loader.fraction)
+        pygame.display.flip()
+        clock.tick(FPS)
+    try:
+        game_engine, inventory_engine, catalog, session_path, session, worker = loader.get()
+    except InferenceFailed as e:
+        print(f"Could not start a game: {e}")
+        pygame.quit()
+        sys.exit(1)
     system_response = ""
     pdf_input = ""
     font_size = HEIGHT // 35
@@ -353,18 +467,29 @@ def main():
     running = True
     text_buffer = []
     image_path = None  # Path to the current image
+    if session is not None:
+        score = session.get('score', 0)
+        text_buffer = session['extra'].get('text_buffer', [])
+        image_path = session['extra'].get('image_path')
+        if image_path and not os.path.exists(image_path):
+            image_path = None
     #system_response, image_path, _ = game_engine.generate_response()
     if image_path is not None:
         show_image(screen, image_path, image_position, image_size)
     update_text_buffer(text_buffer, "> " + input_text, 8)
 
-    for item in start_items:
-        inventory_engine.add_item(InventoryItem(item['name'], item['description'], item['image']))
-
     # Set up timer for self-play
     last_interaction_time = pygame.time.get_ticks()
     inactivity_threshold = 1500  # 5 seconds
+    show_overlay = bool(os.environ.get('KALANDOR_OVERLAY'))
+    # KALANDOR_SPECULATE: 'turn' precomputes the whole next self-play turn while idle,
+    # 'action' only the synthetic user input, 'off' disables speculation
+    speculate = os.environ.get('KALANDOR_SPECULATE', 'turn')
+    speculator = SpeculativeTurn(game_engine, full_turn=speculate == 'turn') if speculate != 'off' else None
+    if speculator:
+        speculator.start()
     while running:
+        frame_start = time.perf_counter()
         current_time = pygame.time.get_ticks()
         mouse_pos = pygame.mouse.get_pos()
         screen.fill(BG_COLOR)
@@ -398,7 +523,10 @@ def main():
 
 
             elif event.type == KEYDOWN:
+                typed = input_text
                 if event.key == K_RETURN:
+                    if speculator:
+                        speculator.cancel()
                     game_engine.add_user_message(input_text)
                     system_response, image_path, new_score = game_engine.generate_response()
                     if image_path is not None:
@@ -408,8 +536,13 @@ def main():
                     if new_score is not None:
                         score += new_score
                     update_text_buffer(text_buffer, "> " + input_text, 8)
-                    update_text_buffer(text_buffer, system_response, 8)
+                    update_text_buffer(text_buffer, system_response if system_response is not None else TURN_FAILED, 8)
                     input_text = ''
+                    telemetry.flush()
+                    if session_path:
+                        save_session(session_path, game_engine, score, text_buffer=text_buffer, image_path=snapshot_path(image_path))
+                    if speculator:
+                        speculator.start()
                 elif event.key == K_BACKSPACE:
                     input_text = input_text[:-1]
                 elif event.key == pygame.K_f and (event.mod & pygame.KMOD_CTRL):
@@ -417,20 +550,45 @@ def main():
                         pygame.display.set_mode((WIDTH, HEIGHT), pygame.RESIZABLE)
                     else:
                         pygame.display.set_mode((WIDTH, HEIGHT), pygame.FULLSCREEN)
+                elif event.key == pygame.K_F3:
+                    show_overlay = not show_overlay
                 else:
                     input_text += event.unicode
+                if speculator and input_text != typed and event.key != K_RETURN:
+                    # The player is writing their own turn: free the backend while they type
+                    speculator.cancel()
 
         if (current_time - last_interaction_time) > inactivity_threshold:
-            user_input = game_engine.self_play()
-            update_text_buffer(text_buffer, "> " + user_input, 8)
-            #render_screen(None, screen, text_buffer, font, base_y, text_area_width, inventory_engine, inventory_position, inventory_area_size, score, score_position, image_area_width, image_path, image_position, image_size)
-            game_engine.add_user_message(user_input)
-            system_response, image_path, new_score = game_engine.generate_response()
-            if system_response is not None:
+            speculated = speculator.take() if speculator else None
+            try:
+                speculated = speculated or (game_engine.self_play(), None)
+            except InferenceFailed as e:
+                print(e)
+                speculated = None
+            answer = None
+            if speculated is not None:
+                user_input, turn = speculated
+                update_text_buffer(text_buffer, "> " + user_input, 8)
+                #render_screen(None, screen, text_buffer, font, base_y, text_area_width, inventory_engine, inventory_position, inventory_area_size, score, score_position, image_area_width, image_path, image_position, image_size)
+                if turn is None:
+                    game_engine.add_user_message(user_input)
+                    turn = game_engine.generate_response()
+                answer, new_image_path, new_score = turn
+            if answer is not None:
+                system_response, image_path = answer, new_image_path
                 update_text_buffer(text_buffer, system_response, 8)
                 if new_score is not None:
                     score += new_score
-                last_interaction_time = pygame.time.get_ticks()  # Reset the timer after self_play
+            last_interaction_time = pygame.time.get_ticks()  # Reset the timer after self_play
+            if answer is None:
+                # Show the failure once and back off: every attempt may restart the worker and reload the models
+                update_text_buffer(text_buffer, TURN_FAILED, 8)
+                last_interaction_time += FAILED_TURN_DELAY
+            telemetry.flush()
+            if session_path:
+                save_session(session_path, game_engine, score, text_buffer=text_buffer, image_path=snapshot_path(image_path))
+            if speculator and answer is not None:
+                speculator.start()
 
         current_input = f"User Input: {user_input}\nSystem Response: {system_response}"
         if pdf_input != current_input:
@@ -455,12 +613,24 @@ def main():
         draw_bordered_box(screen, (text_area_width + 10, 10, image_area_width - 20, HEIGHT - 20), BORDER_COLOR, BORDER_WIDTH)
         if hovered_item_name:
             draw_label(screen, hovered_item_name, hovered_item_description, font, mouse_pos, WIDTH / 3, hovered_item_image)  # Display name at mouse position
+        if show_overlay and telemetry.enabled:
+            draw_overlay(screen, font)
 
         pygame.display.flip()
+        telemetry.record('render.frame', (time.perf_counter() - frame_start) * 1000)
         clock.tick(FPS)
 
-    # Save the PDF before quitting
+    # Save the PDF and the session before quitting
+    if speculator:
+        speculator.cancel()
     pdf.save()
+    telemetry.flush()
+    if catalog is not None:
+        catalog.save()
+    if session_path:
+        save_session(session_path, game_engine, score, text_buffer=text_buffer, image_path=snapshot_path(image_path))
+    if worker is not None:
+        worker.stop()
     pygame.quit()
     sys.exit()
 
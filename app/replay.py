@@ -0,0 +1,167 @@
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# Session archives: every backend call is appended to session.jsonl and images are
+# stored once under images/<sha256>.png, so an archive can be replayed on any machine.
+LOG_NAME = 'session.jsonl'
+IMAGE_DIR = 'images'
+
+
+def prompt_key(prompt):
+    """Stable digest of a chat prompt (list of messages) or an image prompt string."""
+    return hashlib.sha256(json.dumps(prompt, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RecordingBackend:
+    """Wraps another backend and archives every request and response it serves.
+
+    Text prompts are archived by digest only: each one carries the whole history,
+    so storing them grows the archive quadratically with the session length.
+    full_prompts=True keeps them for debugging.
+    """
+
+    def __init__(self, backend, directory, full_prompts=False):
+        self.backend = backend
+        self.directory = directory
+        self.full_prompts = full_prompts
+        self._token_keys = set()  # Counts are deterministic, one record per prompt is enough
+        os.makedirs(os.path.join(directory, IMAGE_DIR), exist_ok=True)
+        self._log = open(os.path.join(directory, LOG_NAME), 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def _write(self, record):
+        with self._lock:
+            self._log.write(json.dumps(record) + '\n')
+            self._log.flush()
+
+    def generate_text(self, prompt):
+        start = time.perf_counter()
+        response = self.backend.generate_text(prompt)
+        record = {'kind': 'text', 'key': prompt_key(prompt), 'response': response,
+                  'elapsed': time.perf_counter() - start}
+        if self.full_prompts:
+            record['prompt'] = prompt
+        self._write(record)
+        return response
+
+    def generate_image(self, prompt):
+        start = time.perf_counter()
+        image_path = self.backend.generate_image(prompt)
+        elapsed = time.perf_counter() - start
+        digest = None
+        if image_path:
+            digest = file_digest(image_path)
+            stored = os.path.join(self.directory, IMAGE_DIR, digest + '.png')
+            if not os.path.exists(stored):
+                shutil.copyfile(image_path, stored)
+        self._write({'kind': 'image', 'key': prompt_key(prompt), 'prompt': prompt, 'digest': digest,
+                     'elapsed': elapsed})
+        return image_path
+
+    def count_tokens(self, prompts):
+        count = self.backend.count_tokens(prompts)
+        key = prompt_key(prompts)
+        if key not in self._token_keys:
+            self._token_keys.add(key)
+            self._write({'kind': 'tokens', 'key': key, 'count': count})
+        return count
+
+    def cleanup(self):
+        cleanup = getattr(self.backend, 'cleanup', None)
+        if cleanup is not None:
+            cleanup()
+
+    def close(self):
+        self._log.close()
+
+
+class ReplayBackend:
+    """Serves the responses of a recorded session without loading any model.
+
+    Requests are matched by prompt digest; prompts that were never recorded (for
+    example after typed input diverges from the recording) get the next unused
+    response of the same kind in recording order. latency_scale=1.0 reproduces the
+    recorded inference time, 0.0 replays at full speed.
+    """
+
+    def __init__(self, directory, latency_scale=0.0):
+        self.directory = directory
+        self.latency_scale = latency_scale
+        self.hits = 0
+        self.misses = 0
+        self._by_key = {'text': collections.defaultdict(collections.deque),
+                        'image': collections.defaultdict(collections.deque)}
+        self._in_order = {'text': [], 'image': []}
+        self._position = {'text': 0, 'image': 0}
+        self._tokens = {}
+        self._lock = threading.Lock()
+        with open(os.path.join(directory, LOG_NAME), encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record['kind'] == 'tokens':
+                    self._tokens[record['key']] = record['count']
+                else:
+                    self._by_key[record['kind']][record['key']].append(record)
+                    self._in_order[record['kind']].append(record)
+
+    def _next(self, kind, prompt):
+        with self._lock:
+            queue = self._by_key[kind].get(prompt_key(prompt))
+            records = self._in_order[kind]
+            if queue:
+                record = queue.popleft()
+                # Keep the last response around so repeated prompts still hit
+                if not queue:
+                    queue.append(record)
+                self.hits += 1
+            elif records:
+                # Prefer responses no digest lookup has consumed yet, then cycle
+                start = self._position[kind]
+                for offset in range(len(records)):
+                    record = records[(start + offset) % len(records)]
+                    if not record.get('used'):
+                        break
+                else:
+                    record = records[start % len(records)]
+                self._position[kind] = records.index(record) + 1
+                self.misses += 1
+            else:
+                raise LookupError(f'Session archive {self.directory} has no {kind} responses')
+            record['used'] = True
+        if self.latency_scale:
+            time.sleep(record['elapsed'] * self.latency_scale)
+        return record
+
+    def generate_text(self, prompt):
+        return self._next('text', prompt)['response']
+
+    def generate_image(self, prompt):
+        digest = self._next('image', prompt)['digest']
+        if digest is None:
+            return None
+        return os.path.join(self.directory, IMAGE_DIR, digest + '.png')
+
+    def count_tokens(self, prompts):
+        count = self._tokens.get(prompt_key(prompts))
+        if count is None:
+            # Not recorded: estimate at about four characters per token
+            count = sum(len(message['content']) // 4 + 1 for message in prompts)
+        return count
+
+    def cleanup(self):
+        pass
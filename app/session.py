@@ -0,0 +1,165 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import uuid
+
+# Session snapshots and the pre-generated starter inventory pool, kept next to the HF cache
+SESSION_PATH = os.path.expanduser('~/kalandor/session.json')
+STARTER_DIR = os.path.expanduser('~/kalandor/starters')
+SESSION_VERSION = 1
+
+
+def write_json_atomic(path, data):
+    """Write JSON so readers only ever see the old or the new file, never a torn one."""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f'.{os.path.basename(path)}.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+_stored_images = {}  # (path, mtime, size) -> content-hash file name, so autosaves hash each icon once
+
+
+def store_image(path, image_dir):
+    """Copy an image into image_dir under its content hash and return that file name."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    name = _stored_images.get(key)
+    if name is None:
+        with open(path, 'rb') as f:
+            name = _stored_images[key] = hashlib.sha256(f.read()).hexdigest() + '.png'
+    stored = os.path.join(image_dir, name)
+    if not os.path.exists(stored):
+        os.makedirs(image_dir, exist_ok=True)
+        shutil.copyfile(path, stored)
+    return name
+
+
+def save_session(path, game_engine, score=0, **extra):
+    """Snapshot the engine state plus UI extras such as the text buffer.
+
+    Item icons are copied into <snapshot>_images, so evicting them from the item
+    catalog or clearing temp/ cannot empty the inventory of a saved game.
+    """
+    state = game_engine.get_state()
+    image_dir = os.path.abspath(os.path.splitext(path)[0] + '_images')
+    kept = set()
+    for item in state['inventory']:
+        if item['image'] and os.path.exists(item['image']):
+            name = store_image(item['image'], image_dir)
+            item['image'] = os.path.join(image_dir, name)
+            kept.add(name)
+    state.update(version=SESSION_VERSION, score=score, extra=extra)
+    write_json_atomic(path, state)
+    if os.path.isdir(image_dir):
+        for name in os.listdir(image_dir):
+            if name not in kept:
+                os.remove(os.path.join(image_dir, name))
+
+
+def load_session(path, game_engine):
+    """Restore a snapshot into game_engine; returns it for score and extras, or None if there is none."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        print(f"Ignoring unreadable session snapshot {path}: {e}")
+        return None
+    if state.get('version') != SESSION_VERSION or not state.get('messages'):
+        return None
+    game_engine.set_state(state)
+    return state
+
+
+class StarterPool:
+    """Directory of ready-made starter inventories, filled offline and consumed one per new game."""
+
+    def __init__(self, directory=STARTER_DIR):
+        self.directory = directory
+        self.image_dir = os.path.join(directory, 'images')
+
+    def packs(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('pack_') and name.endswith('.json'))
+
+    def __len__(self):
+        return len(self.packs())
+
+    def add(self, items):
+        """Store one starter inventory, copying the icons into the pool."""
+        os.makedirs(self.image_dir, exist_ok=True)
+        pack = []
+        for item in items:
+            image = None
+            if item.get('image') and os.path.exists(item['image']):
+                image = store_image(item['image'], self.image_dir)
+            pack.append({'name': item['name'], 'description': item['description'], 'image': image})
+        write_json_atomic(os.path.join(self.directory, f'pack_{uuid.uuid4().hex}.json'), pack)
+
+    def draw(self):
+        """Take one pack out of the pool in get_start_items() format, or None if the pool is empty."""
+        for name in self.packs():
+            path = os.path.join(self.directory, name)
+            claimed = path + '.claimed'
+            try:
+                # Renaming claims the pack, so two games starting at once never share one
+                os.replace(path, claimed)
+            except OSError:
+                continue
+            try:
+                with open(claimed, encoding='utf-8') as f:
+                    pack = json.load(f)
+            except ValueError:
+                continue
+            finally:
+                os.remove(claimed)
+            items = []
+            for item in pack:
+                image = os.path.join(self.image_dir, item['image']) if item['image'] else None
+                if image and os.path.exists(image):
+                    items.append({'name': item['name'], 'description': item['description'], 'image': image})
+            if items:
+                return items
+        return None
+
+    def fill(self, inventory_engine, count):
+        """Generate packs with the engine's backend until the pool holds count of them."""
+        while len(self) < count:
+            try:
+                self.add(inventory_engine.get_start_items())
+            except (SyntaxError, ValueError) as e:
+                print(f"Discarding unparseable starter inventory: {e}")
+                continue
+            print(f"Starter pool: {len(self)}/{count}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-generate starter inventories for fast game startup.')
+    parser.add_argument('--count', type=int, default=10, help='number of packs the pool should hold')
+    parser.add_argument('--pool', default=STARTER_DIR)
+    parser.add_argument('--slots', type=int, default=6)
+    parser.add_argument('--backend', default='local')
+    args = parser.parse_args(argv)
+
+    from llm import APICommunication, InventoryEngine, load_backend
+    inventory_engine = InventoryEngine(APICommunication(backend=load_backend(args.backend)), args.slots)
+    StarterPool(args.pool).fill(inventory_engine, args.count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import threading
+
+import telemetry
+from llm import APICommunication, InferenceFailed, InventoryEngine, TextGameEngine, TurnCancelled
+
+
+def fork_engine(game_engine, api_comms):
+    """Copy of the game state that can play a turn without touching the original."""
+    fork = TextGameEngine(game_engine.max_tokens, api_comms=api_comms)
+    inventory = game_engine.inventory_engine
+    fork.inventory_engine = InventoryEngine(api_comms, inventory.max_slots, catalog=inventory.catalog)
+    fork.inventory_engine.items = list(inventory.items)  # InventoryItems are shared, the list is not
+    fork.messages = [dict(message) for message in game_engine.messages]
+    fork.initial_message = fork.messages[0]
+    fork.location = game_engine.location
+    fork.summary = game_engine.summary
+    fork.reminder = game_engine.reminder
+    return fork
+
+
+class _Run:
+    """One speculation: its thread, cancel flag, the state it started from and its result."""
+
+    def __init__(self, base):
+        self.base = base
+        self.cancel = threading.Event()
+        self.thread = None
+        self.result = None
+
+
+class SpeculativeTurn:
+    """Plays the next self-play turn in the background while the player is idle.
+
+    start() forks the engine and runs self_play() (and, with full_turn, the
+    scenario and image as well) on a worker thread. take() commits the finished
+    result into the real engine, waiting for it if it is still running; cancel()
+    drops it and makes the forked turn abort before its next backend call.
+    """
+
+    def __init__(self, game_engine, full_turn=True):
+        self.game_engine = game_engine
+        self.full_turn = full_turn
+        self._run = None
+
+    def _base_state(self):
+        return len(self.game_engine.messages), self.game_engine.messages[-1]['content']
+
+    def start(self):
+        """Begin speculating from the current state, replacing any earlier speculation."""
+        self.cancel()
+        run = _Run(self._base_state())
+        parent = self.game_engine.api_comms
+        # Same token cache as the real engine, so the shared history is not re-tokenized every turn
+        api_comms = APICommunication(backend=parent.backend, cancel_event=run.cancel, token_counts=parent.token_counts)
+        fork = fork_engine(self.game_engine, api_comms)
+        # Each run writes only its own result, so a cancelled thread finishing late cannot be taken
+        run.thread = threading.Thread(target=self._play, args=(fork, run), daemon=True)
+        self._run = run
+        run.thread.start()
+
+    def _play(self, fork, run):
+        try:
+            with telemetry.span('speculative.turn', full_turn=self.full_turn):
+                user_input = fork.self_play()
+                turn = None
+                if self.full_turn:
+                    fork.add_user_message(user_input)
+                    turn = fork.generate_response()
+        except TurnCancelled:
+            telemetry.count('speculative.cancelled')
+            return
+        except InferenceFailed as e:
+            # The real turn will run into the same failure and report it
+            print(f"Speculative turn failed: {e}")
+            return
+        if not run.cancel.is_set():
+            run.result = (fork, user_input, turn)
+
+    def cancel(self):
+        if self._run is not None:
+            self._run.cancel.set()
+        self._run = None
+
+    def take(self):
+        """Commit the speculative turn; returns (user_input, (answer, image, score) or None), or None if unusable."""
+        run, self._run = self._run, None
+        if run is None:
+            return None
+        run.thread.join()
+        if run.result is None or run.base != self._base_state():
+            telemetry.count('speculative.discarded')
+            return None
+        fork, user_input, turn = run.result
+        if turn is not None:
+            if turn[0] is None:
+                # The forked turn failed; let the caller retry it for real
+                return user_input, None
+            engine = self.game_engine
+            engine.messages = fork.messages
+            engine.initial_message = fork.initial_message
+            engine.location = fork.location
+            engine.summary = fork.summary
+            engine.inventory_engine.items = fork.inventory_engine.items
+        telemetry.count('speculative.committed')
+        return user_input, turn
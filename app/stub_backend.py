@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import random
+import re
+import time
+
+import pygame
+
+# Drop-in replacement for inference.py that needs neither a GPU nor model weights.
+# Responses follow the formats the engine prompts for, so TextGameEngine and
+# InventoryEngine can be driven through every code path headlessly.
+os.makedirs('temp', exist_ok=True)
+
+ITEMS = ['torch', 'rope', 'health potion', 'iron key', 'old map', 'dagger', 'lantern', 'bread', 'compass', 'shield']
+LOCATIONS = ['Dark Forest', 'Abandoned Mine', 'Harbor Town', 'Crystal Cave', 'Ruined Tower']
+ACTIONS = ['no_action', 'no_action', 'add_to_inventory', 'use_inventory_item', 'remove_from_inventory']
+
+rng = random.Random(0)
+# Environment defaults reach stubs loaded inside worker processes, e.g. by farm.py
+text_latency = float(os.environ.get('KALANDOR_STUB_TEXT_LATENCY', 0))
+image_latency = float(os.environ.get('KALANDOR_STUB_IMAGE_LATENCY', 0))
+
+
+def configure(seed=0, text_delay=0.0, image_delay=0.0):
+    """Reseed the stub and set simulated per-call latencies in seconds."""
+    global rng, text_latency, image_latency
+    rng = random.Random(seed)
+    text_latency = text_delay
+    image_latency = image_delay
+
+
+def _sentence(words=12):
+    vocabulary = ['the', 'a', 'shadow', 'door', 'creaks', 'light', 'wind', 'you', 'see', 'path', 'stone',
+                  'whispers', 'ancient', 'glows', 'beyond', 'river', 'north', 'guard', 'waits', 'silently']
+    return ' '.join(rng.choice(vocabulary) for _ in range(words)).capitalize() + '.'
+
+
+def generate_text(prompt):
+    time.sleep(text_latency)
+    system = prompt[0]['content'] if prompt else ''
+    last = prompt[-1]['content'] if prompt else ''
+
+    match = re.search(r'fill a (\d+) slot inventory', system)
+    if match:
+        names = rng.sample(ITEMS, min(int(match.group(1)), len(ITEMS)))
+        return json.dumps([{'name': name, 'description': f'A {name}. ' + _sentence(8)} for name in names])
+    if 'generate a single item' in system:
+        name = re.search(r'for the item (.*?) You must', last)
+        name = name.group(1).strip() if name else rng.choice(ITEMS)
+        return json.dumps({'name': name, 'description': f'A {name}. ' + _sentence(8)})
+    if 'make use of the item' in system:
+        return str({'effect': _sentence(10), 'keep_item': rng.random() < 0.7})
+    if 'emulating user input' in system:
+        return f'I {rng.choice(["look around", "walk north", "open the door", "talk to the guard"])} and ' \
+               f'{rng.choice(["check my bag", "listen", "wait", "pick up the " + rng.choice(ITEMS)])}'
+    if 'conclude the previous happenings' in last:
+        return json.dumps({'summary': _sentence(30), 'location': rng.choice(LOCATIONS)})
+    return json.dumps({
+        'image': 'pixel art, ' + _sentence(6),
+        'answer': _sentence(40) + ' What do you do next?',
+        'score': rng.randint(-10, 10),
+        'action': rng.choice(ACTIONS),
+        'item': rng.choice(ITEMS),
+        'location': rng.choice(LOCATIONS),
+    })
+
+
+def generate_image(prompt):
+    time.sleep(image_latency)
+    digest = hashlib.sha1(prompt.encode('utf-8')).digest()
+    surface = pygame.Surface((64, 64))
+    surface.fill(pygame.Color(digest[0], digest[1], digest[2]))
+    image_path = f"temp/stub_{digest.hex()[:16]}.png"
+    # Concurrent stubs may write the same prompt's image; readers must never see a partial file
+    tmp_path = f"temp/.stub_{digest.hex()[:16]}_{os.getpid()}.png"
+    pygame.image.save(surface, tmp_path)
+    os.replace(tmp_path, image_path)
+    return image_path
+
+
+def cleanup():
+    pass
+
+
+def count_tokens(prompts):
+    # Roughly four characters per token, close enough for history-length effects
+    return sum(len(message['content']) // 4 + 1 for message in prompts)
@@ -0,0 +1,157 @@
+import collections
+import json
+import os
+import threading
+import time
+
+# Lightweight spans and counters. Disabled unless KALANDOR_TRACE (a JSON-lines path)
+# or KALANDOR_OVERLAY is set; while disabled span() hands out a shared no-op object
+# and count() returns immediately, so instrumented code pays one attribute check.
+enabled = False
+counters = collections.Counter()
+recent = {}  # span name -> deque of the latest durations in ms, for the overlay
+
+_path = None
+_file = None
+_max_bytes = 0
+_backups = 0
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack else None
+        stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        _local.stack.pop()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        entry = {'ts': time.time(), 'span': self.name, 'ms': round(elapsed_ms, 3)}
+        if self.parent:
+            entry['parent'] = self.parent
+        entry.update(self.attrs)
+        _emit(self.name, elapsed_ms, entry)
+        return False
+
+    def set(self, **attrs):
+        """Attach attributes discovered while the span is running, e.g. token counts."""
+        self.attrs.update(attrs)
+
+
+def configure(path=None, overlay=False, max_bytes=16 * 1024 * 1024, backups=3):
+    """Enable tracing to a rolling JSON-lines file and/or the in-memory overlay buffers."""
+    global enabled, _path, _file, _max_bytes, _backups
+    with _lock:
+        if _file is not None:
+            _file.close()
+            _file = None
+        _path = path
+        _max_bytes = max_bytes
+        _backups = backups
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            _file = open(path, 'a', encoding='utf-8')
+        enabled = bool(path or overlay)
+
+
+def span(name, **attrs):
+    """Time a block: `with telemetry.span('inference.diffusion', steps=7): ...`."""
+    if not enabled:
+        return _NOOP
+    return _Span(name, attrs)
+
+
+def record(name, elapsed_ms, **attrs):
+    """Report a duration measured elsewhere, e.g. prefill time taken from a generation callback."""
+    if not enabled:
+        return
+    entry = {'ts': time.time(), 'span': name, 'ms': round(elapsed_ms, 3)}
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        entry['parent'] = stack[-1]
+    entry.update(attrs)
+    _emit(name, elapsed_ms, entry)
+
+
+def count(name, n=1):
+    if enabled:
+        with _lock:
+            counters[name] += n
+
+
+def flush():
+    """Write the counter totals as one record, e.g. once per turn."""
+    if not enabled:
+        return
+    with _lock:
+        snapshot = dict(counters)
+    _write({'ts': time.time(), 'counters': snapshot})
+
+
+def summary():
+    """Latest and mean duration per span name, for on-screen display."""
+    with _lock:
+        return {name: (samples[-1], sum(samples) / len(samples)) for name, samples in recent.items() if samples}
+
+
+def _emit(name, elapsed_ms, entry):
+    with _lock:
+        samples = recent.get(name)
+        if samples is None:
+            samples = recent[name] = collections.deque(maxlen=60)
+        samples.append(elapsed_ms)
+    _write(entry)
+
+
+def _write(entry):
+    global _file
+    if _file is None:
+        return
+    line = json.dumps(entry) + '\n'
+    with _lock:
+        if _file is None:
+            return
+        if _max_bytes and _file.tell() + len(line) > _max_bytes:
+            _file.close()
+            # trace.jsonl -> trace.jsonl.1 -> ... -> trace.jsonl.<backups>
+            for index in range(_backups - 1, 0, -1):
+                if os.path.exists(f'{_path}.{index}'):
+                    os.replace(f'{_path}.{index}', f'{_path}.{index + 1}')
+            if _backups:
+                os.replace(_path, f'{_path}.1')
+            else:
+                os.remove(_path)
+            _file = open(_path, 'a', encoding='utf-8')
+        _file.write(line)
+        _file.flush()
+
+
+configure(os.environ.get('KALANDOR_TRACE'), overlay=bool(os.environ.get('KALANDOR_OVERLAY')))
@@ -0,0 +1,282 @@
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import connection, shared_memory
+
+import telemetry
+from llm import InferenceFailed
+
+# One shared-memory block per client carries the RGB pixels of each generated image
+# back to the UI process (1024x1024 RGBA fits), so it never decodes the PNG itself.
+BUFFER_SIZE = 1024 * 1024 * 4
+IMAGE_OPS = ('generate_image',)
+# A request that keeps killing the worker (one prompt crashing diffusion every time)
+# is failed after this many resends instead of looping through restarts forever
+MAX_RESENDS = 2
+
+
+def _serve(spec, pipes, control, buffer_names, ready):
+    """Worker process: owns the models and answers requests until told to stop on the control pipe."""
+    from llm import load_backend
+
+    # The UI process owns KALANDOR_TRACE; two processes must not append to and rotate one file
+    if os.environ.get('KALANDOR_TRACE'):
+        telemetry.configure(os.environ['KALANDOR_TRACE'] + '.worker')
+    backend = load_backend(spec)
+    buffers = [shared_memory.SharedMemory(name=name) for name in buffer_names]
+    ready.set()
+    running = True
+    while running:
+        for pipe in connection.wait(pipes + [control]):
+            if pipe is control:
+                running = False
+                break
+            client_id = pipes.index(pipe)
+            request_id, op, args = pipe.recv()
+            try:
+                if op in IMAGE_OPS:
+                    result = _image(backend, buffers[client_id], args[0])
+                else:
+                    result = getattr(backend, op)(*args)
+                if op.startswith('generate') and hasattr(backend, 'cleanup'):
+                    backend.cleanup()
+                pipe.send((request_id, True, result))
+            except Exception as e:
+                pipe.send((request_id, False, repr(e)))
+                if 'CUDA' in repr(e):
+                    # The CUDA context may be unusable now; exit so the supervisor starts a fresh process
+                    running = False
+                    break
+    for buffer in buffers:
+        buffer.close()
+    telemetry.flush()
+
+
+def _image(backend, buffer, prompt):
+    """Returns (path, size, nbytes); size is None when the pixels did not go through shared memory."""
+    if not hasattr(backend, 'render_image'):
+        return backend.generate_image(prompt), None, 0
+    try:
+        image = backend.render_image(prompt)
+    except Exception as e:
+        print("IMAGE INFERENCE FAILED", repr(e))
+        telemetry.count('inference.image_failures')
+        return None, None, 0
+    # The PNG is still written (session log, catalog, snapshots), but here, off the UI process
+    path = backend.save_image(image, prompt)
+    data = image.convert('RGB').tobytes()
+    if len(data) > buffer.size:
+        return path, None, 0
+    buffer.buf[:len(data)] = data
+    return path, image.size, len(data)
+
+
+class WorkerError(InferenceFailed):
+    """The inference worker cannot serve requests: it keeps dying on one or fails to load."""
+
+
+class RequestFailed(WorkerError):
+    """The worker raised an exception while serving a request; the next one may succeed."""
+
+
+class InferenceWorker:
+    """Supervises a process that loads a backend and serves one or more WorkerBackend clients.
+
+    Each client has its own duplex pipe and shared-memory image buffer. Pipes rather
+    than multiprocessing queues because a queue's internal lock stays held forever if
+    the process dies inside get(). If the process dies (CUDA OOM, a crash in
+    diffusion) it is restarted on the same pipes and clients resend what was in
+    flight, so the game session in the UI process is unaffected.
+    """
+
+    def __init__(self, spec='local', clients=1, context='spawn'):
+        # spawn rather than fork: CUDA cannot be re-initialised in a forked child
+        self.spec = spec
+        self.context = multiprocessing.get_context(context)
+        self.pipes = [self.context.Pipe() for _ in range(clients)]  # (client end, worker end)
+        self._control = self.context.Pipe()
+        self.buffers = [shared_memory.SharedMemory(create=True, size=BUFFER_SIZE) for _ in range(clients)]
+        self.ready = self.context.Event()
+        self.process = None
+        # Shared so clients in other processes (farm.py's pool) can tell when a request was lost
+        self.restart_count = self.context.Value('i', 0)
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def start(self, wait=True):
+        self.ready.clear()
+        self.process = self.context.Process(
+            target=_serve,
+            args=(self.spec, [pipe[1] for pipe in self.pipes], self._control[1], [buffer.name for buffer in self.buffers], self.ready),
+            daemon=True)
+        self.process.start()
+        if wait:
+            self.wait_ready()
+        return self
+
+    def wait_ready(self):
+        while not self.ready.wait(0.5):
+            if not self.alive:
+                raise WorkerError(f"Inference worker exited with code {self.process.exitcode} while loading '{self.spec}'")
+
+    @property
+    def restarts(self):
+        return self.restart_count.value
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def ensure_running(self):
+        """Restart the worker if it has died; returns True if a restart happened."""
+        with self._lock:
+            if self._stopped or self.alive:
+                return False
+            with self.restart_count.get_lock():
+                self.restart_count.value += 1
+            telemetry.count('worker.restarts')
+            print(f"Inference worker died (exit code {self.process.exitcode}), restarting")
+            self.start(wait=False)
+            return True
+
+    def supervise(self, interval=1.0):
+        """Watch the process from a daemon thread and restart it whenever it dies."""
+        def watch():
+            while not self._stopped:
+                self.ensure_running()
+                time.sleep(interval)
+        threading.Thread(target=watch, daemon=True).start()
+
+    def client(self, client_id=0, timeout=None):
+        return WorkerBackend(self.pipes[client_id][0], self.buffers[client_id].name, worker=self, timeout=timeout,
+                             restart_count=self.restart_count)
+
+    def stop(self):
+        self._stopped = True
+        if self.alive:
+            self._control[0].send(None)
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+        for buffer in self.buffers:
+            buffer.close()
+            buffer.unlink()
+
+
+class WorkerBackend:
+    """Backend interface (generate_text, generate_image, count_tokens, cleanup) served by an InferenceWorker.
+
+    Can be handed to a spawned process; there it has no handle on the worker
+    process, but still sees the shared restart counter and resends what a restart
+    lost. `timeout` is only a last resort: it counts time spent queued behind other
+    clients' requests as well.
+    """
+
+    def __init__(self, pipe, buffer_name, worker=None, timeout=None, poll=0.5, restart_count=None):
+        self.pipe = pipe
+        self.buffer_name = buffer_name
+        self.worker = worker
+        self.timeout = timeout
+        self.poll = poll
+        self.restart_count = restart_count
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._buffer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['worker'], state['_ids'], state['_lock'], state['_buffer']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.worker = None
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._buffer = None
+
+    def _call(self, op, *args):
+        with self._lock:
+            request_id = next(self._ids)
+            self.pipe.send((request_id, op, args))
+            sent = time.monotonic()
+            resends = 0
+            restarts = self._restarts()
+            while True:
+                if not self.pipe.poll(self.poll):
+                    resend = False
+                    if self.worker is not None:
+                        self.worker.ensure_running()
+                    if self._restarts() != restarts:
+                        # A restart (by us or the supervisor) lost the request; ask the new process again
+                        restarts = self._restarts()
+                        if self.worker is not None:
+                            self.worker.wait_ready()
+                        resend = True
+                    elif self.timeout is not None and time.monotonic() - sent > self.timeout:
+                        resend = True
+                    if resend:
+                        if resends == MAX_RESENDS:
+                            raise WorkerError(f"Inference worker gave up on {op} after {resends} resends")
+                        resends += 1
+                        telemetry.count('worker.resent')
+                        self.pipe.send((request_id, op, args))
+                        sent = time.monotonic()
+                    continue
+                reply_id, ok, result = self.pipe.recv()
+                if reply_id != request_id:
+                    continue  # Late answer to a request that was already resent
+                if not ok:
+                    raise RequestFailed(f"Inference worker failed on {op}: {result}")
+                if op in IMAGE_OPS:
+                    return self._receive_image(*result)
+                return result
+
+    def _restarts(self):
+        return self.restart_count.value if self.restart_count is not None else 0
+
+    def _receive_image(self, path, size, nbytes):
+        if path is not None and size is not None:
+            import pygame
+            from llm import register_image
+
+            if self._buffer is None:
+                self._buffer = shared_memory.SharedMemory(name=self.buffer_name)
+            surface = pygame.image.frombuffer(bytes(self._buffer.buf[:nbytes]), size, 'RGB')
+            register_image(path, surface)
+        return path
+
+    # Failures come back as the values the engine already handles: 'fail' makes
+    # APICommunication retry the text, None is a turn without an image. A worker
+    # that gave up raises WorkerError from generate_text, so the turn fails at once
+
+    def generate_text(self, prompt):
+        try:
+            return self._call('generate_text', prompt)
+        except RequestFailed as e:
+            print(e)
+            telemetry.count('worker.failures')
+            return 'fail'
+
+    def generate_image(self, prompt):
+        try:
+            return self._call('generate_image', prompt)
+        except WorkerError as e:
+            print(e)
+            telemetry.count('worker.failures')
+            return None
+
+    def count_tokens(self, prompts):
+        try:
+            return self._call('count_tokens', prompts)
+        except WorkerError as e:
+            print(e)
+            telemetry.count('worker.failures')
+            # Only used for the history budget, so an estimate of about four characters per token will do
+            return sum(len(message['content']) // 4 + 1 for message in prompts)
+
+    def cleanup(self):
+        # The worker cleans up after every generation itself
+        pass